@@ -32,6 +32,12 @@ socketAgeLimit = 2 * 60         # 2 minutes
 #
 historyAgeLimit = 1 * 60 * 60   # 1 hour
 
+# Approximate number of bytes the notification history may use before the oldest entries are dropped, regardless
+# of historyAgeLimit. Each entry is counted as its request object, frame bytes, timestamp, identifier and deque
+# pointer; allocator and deque block overhead are not, so actual use runs a few percent higher.
+#
+historyMemoryLimit = 32 * 1024 * 1024   # 32 MB
+
 # Number of seconds to wait for data when reading from the APNs socket
 #
 socketReadTimeout = 2.0         # 2 seconds
@@ -39,3 +45,16 @@ socketReadTimeout = 2.0         # 2 seconds
 # Number of times to try to post a notification before giving up on it.
 #
 maxPostRetries = 5
+
+# Fraction of notification requests (0.0 - 1.0) to trace through each processing stage. 0 disables tracing.
+#
+traceSampleRate = 0.0
+
+# Number of seconds a traced request may take, end to end, before it is kept as a slow trace. NOTE: every request
+# waits up to socketReadTimeout for an error response from APNs, so this should be larger than that.
+#
+traceSlowThreshold = 3.0        # 3 seconds
+
+# Number of most recent slow traces to keep.
+#
+traceSlowKeep = 100
@@ -1,12 +1,21 @@
+import collections
 import config
+import itertools
 import os
 import socket
 import ssl
 import struct
+import sys
+import threading
 import time
 import traceback
 import Logger
 
+try:
+    from importlib import reload
+except ImportError:
+    pass                        # Python 2 - use builtin reload
+
 def tohex(s):
     '''Convert string of 8-bit characters into 2 hex digits each
     '''
@@ -18,15 +27,23 @@ def fromhex(s):
     return ''.join([chr(int(''.join(c), 16)) for c in zip(s[0::2],s[1::2])])
 
 class PushRequest(object):
-    def __init__(self, identifier, msg):
+    __slots__ = ('identifier', 'msg', 'when', 'attempts', 'trace')
+
+    def __init__(self, identifier, msg, trace = None):
         self.identifier = identifier
         self.msg = msg
         self.when = time.time()
         self.attempts = 0
+        self.trace = trace
+
+def connectionSettings():
+    '''Return the config values that require a new APNs connection when they change.
+    '''
+    return (config.useSandbox, config.apnsCertFile, config.apnsKeyFile)
 
 class APNs(object):
 
-    host = ['gateway.push.apple.com', 'gateway.sandbox.push.apple.com'][config.useSandbox]
+    kHosts = ['gateway.push.apple.com', 'gateway.sandbox.push.apple.com']
     port = 2195
 
     kErrors = {
@@ -48,14 +65,22 @@ class APNs(object):
         self.__service = None
         self.__identifier = 1
         self.__whenLastPost = 0
-        self.__history = []
+        self.__history = collections.deque()
+        self.__historyBytes = 0
+        self.__historyEvictions = 0
         self.__pending = []
+        self.__lock = threading.Lock()
+        self.__reloadRequested = False
+        self.__settings = connectionSettings()
+        self.host = self.kHosts[config.useSandbox]
 
     def generatePayload(self, msg, badge):
         return config.payloadTemplate.format(msg, badge)
 
-    def connect(self):
-        gLog.info('connect')
+    def openConnection(self):
+        '''Create and connect a new TLS socket to APNs using the current config values. Returns None on failure.
+        '''
+        host = self.kHosts[config.useSandbox]
 
         # Create underlying TCP socket to use for notification transport to Apple
         #
@@ -68,18 +93,103 @@ class APNs(object):
         sock.settimeout(config.socketReadTimeout)
 
         pwd = os.getcwd()
-        self.__service = ssl.wrap_socket(sock, 
-                                         keyfile = os.path.join(pwd, config.apnsKeyFile ),
-                                         certfile = os.path.join(pwd, config.apnsCertFile),
-                                         ssl_version = ssl.PROTOCOL_TLSv1)
+        service = ssl.wrap_socket(sock, 
+                                  keyfile = os.path.join(pwd, config.apnsKeyFile ),
+                                  certfile = os.path.join(pwd, config.apnsCertFile),
+                                  ssl_version = ssl.PROTOCOL_TLSv1)
 
         try:
-            self.__service.connect((self.host, self.port))
-            gLog.info('connected to', self.host, self.port)
+            service.connect((host, self.port))
+            gLog.info('connected to', host, self.port)
         except:
             traceback.print_exc()
-            gLog.error('failed to connect to', self.host, self.port)
-            self.__service = None
+            gLog.error('failed to connect to', host, self.port)
+            return None
+
+        return service
+
+    def connect(self):
+        gLog.info('connect')
+        self.__service = self.openConnection()
+        self.__settings = connectionSettings()
+        self.host = self.kHosts[config.useSandbox]
+
+    def requestReload(self):
+        '''Ask for a config reload before the next post. Safe to call from a signal handler.
+        '''
+        self.__reloadRequested = True
+
+    kReloaded = 1
+    kReloadFailed = 2
+    kRotationDeferred = 3
+
+    def reloadConfig(self):
+        '''Reload config.py and apply it to the live connection without dropping pending requests. Returns
+        kReloaded, kReloadFailed (nothing changed), or kRotationDeferred (new values are live but the existing
+        connection is kept until it is next recycled).
+        '''
+        with self.__lock:
+            return self.__reloadConfig()
+
+    def __reloadConfig(self):
+        gLog.begin()
+        self.__reloadRequested = False
+
+        try:
+            reload(config)
+        except:
+            traceback.print_exc()
+            gLog.error('failed to reload config - keeping current values')
+            gLog.end(False)
+            return self.kReloadFailed
+
+        # Apply the new read timeout to the existing socket, and let processPending pick up the other
+        # tunables on its next pass.
+        #
+        if self.__service != None:
+            self.__service.settimeout(config.socketReadTimeout)
+
+        settings = connectionSettings()
+        if settings == self.__settings:
+            gLog.end(True)
+            return self.kReloaded
+
+        gLog.warning('APNs connection settings changed - rotating connection')
+
+        if self.__service == None:
+            self.__settings = settings
+            self.host = self.kHosts[config.useSandbox]
+            gLog.end(True)
+            return self.kReloaded
+
+        # Warm up a connection with the new host/cert before giving up the old one. If that fails,
+        # keep using the old connection; the next recycle will try the new settings again.
+        #
+        service = self.openConnection()
+        if service == None:
+            gLog.error('tunables applied, connection rotation deferred - failed to connect with new settings,',
+                       'keeping existing APNs connection to', self.host)
+            gLog.end(False)
+            return self.kRotationDeferred
+
+        old = self.__service
+        self.__service = service
+        self.__settings = settings
+        self.host = self.kHosts[config.useSandbox]
+        self.__whenLastPost = time.time()
+
+        # Requests already written on the old connection cannot be replayed on the new one if APNs
+        # reports an error for them, so start a fresh history.
+        #
+        self.clearHistory()
+
+        try:
+            old.close()
+        except:
+            pass
+
+        gLog.end(True)
+        return self.kReloaded
 
     def close(self):
         if self.__service:
@@ -89,7 +199,7 @@ class APNs(object):
                 pass
             self.__service = None
 
-    def post(self, deviceToken, msg, badge, expiry = 0):
+    def post(self, deviceToken, msg, badge, expiry = 0, trace = None):
         gLog.begin()
 
         deviceToken = fromhex(deviceToken)
@@ -99,6 +209,8 @@ class APNs(object):
             return False
 
         payload = self.generatePayload(msg, badge)
+        if trace:
+            trace.stamp('payload')
 
         size = len(payload)
         gLog.debug('payload size:', size)
@@ -116,14 +228,6 @@ class APNs(object):
         gLog.debug(2, tohex(frameItem))
         frame += frameItem
 
-        # Item 3 - notification identifier (1 byte + 2 bytes + 4 bytes = 7)
-        #
-        identifier = self.__identifier
-        self.__identifier += 1
-        frameItem = struct.pack('!BHI', 3, 4, identifier)
-        gLog.debug(3, tohex(frameItem))
-        frame += frameItem
-
         if expiry > 0:
             
             # Item 4 - expiration date (1 byte + 2 bytes + 4 bytes = 7)
@@ -137,16 +241,39 @@ class APNs(object):
         priority = 10           # send immediately
         frameItem = struct.pack('!BHB', 5, 1, priority)
         gLog.debug(5, tohex(frameItem))
-        frame += frameItem
+        frameTail = frameItem
+        if trace:
+            trace.stamp('framed')
 
-        # Frame (1 byte + 2 bytes + len(frame) = 3 + len)
-        #
-        msg = struct.pack('!BI', 2, len(frame)) + frame
-        gLog.debug(tohex(msg))
+        with self.__lock:
+            if self.__reloadRequested:
+                self.__reloadConfig()
+
+            # Item 3 - notification identifier (1 byte + 2 bytes + 4 bytes = 7). Allocated under the same lock
+            # as the enqueue so that the history stays in identifier order, which replay depends on.
+            #
+            identifier = self.__identifier
+            self.__identifier += 1
+            frameItem = struct.pack('!BHI', 3, 4, identifier)
+            gLog.debug(3, tohex(frameItem))
+            frame += frameItem + frameTail
 
-        self.__pending.append(PushRequest(identifier, msg))
-        self.processPending()
-        self.pruneHistory()
+            # Frame (1 byte + 2 bytes + len(frame) = 3 + len)
+            #
+            msg = struct.pack('!BI', 2, len(frame)) + frame
+            gLog.debug(tohex(msg))
+
+            if trace:
+                trace.stamp('enqueue')
+            request = PushRequest(identifier, msg, trace)
+            self.__pending.append(request)
+            self.processPending()
+            self.pruneHistory()
+
+            # The caller owns the trace; don't keep it alive in the history. Cleared under the lock so that a
+            # later replay of this request cannot stamp a trace the caller is finishing.
+            #
+            request.trace = None
 
     kRetry = 1
     kOK = 2
@@ -167,30 +294,36 @@ class APNs(object):
             if self.__service == None:
                 self.connect()
 
-            request = self.__pending[0]
+            # processOne puts the request back in the pending list if it needs to be sent again.
+            #
+            request = self.__pending.pop(0)
             if request.attempts < config.maxPostRetries:
-                rc = self.processOne(request)
-                if rc == self.kRetry:
-                    continue
-            del self.__pending[0]
+                self.processOne(request)
 
     def processOne(self, request):
         gLog.begin()
 
         # Try writing to the socket. If we fail, retry.
         #
+        trace = request.trace
         try:
             request.attempts += 1
+            if trace:
+                trace.stamp('write')
             rc = self.__service.write(request.msg)
             gLog.debug('sent:', rc)
+            if trace:
+                trace.stamp('written')
             if rc != len(request.msg):
                 raise RuntimeError('write failed')
         except:
             traceback.print_exc()
             self.close()
+            self.__pending.insert(0, request)
             return self.kRetry
 
         self.__history.append(request)
+        self.__historyBytes += self.requestSize(request)
         self.__whenLastPost = time.time()
 
         # Try fetching from the socket. If there is anything, then something went wrong.
@@ -198,6 +331,8 @@ class APNs(object):
         #
         try:
             raw = self.__service.recv(6)
+            if trace:
+                trace.stamp('confirmed')
             if raw != None and len(raw) == 6:
                 command, status, identifier = struct.unpack('!BBI', raw)
                 gLog.debug(command, status, identifier)
@@ -209,13 +344,13 @@ class APNs(object):
                 # Locate the first historical request that has an identifier greater than what APNs returned.
                 # We need to resend requests from that point in the history.
                 #
-                for index, request in enumerate(self.__history):
-                    if request.identifier > identifier:
-                        redo = self.__history[index:]
+                for index, each in enumerate(self.__history):
+                    if each.identifier > identifier:
+                        redo = list(itertools.islice(self.__history, index, None))
                         for each in redo:
-                            redo.attempts = 0
+                            each.attempts = 0
                         self.__pending = redo + self.__pending
-                        self.__history = []
+                        self.clearHistory()
                         break
 
                 # Regardless of status code, the socket is no longer usable.
@@ -230,6 +365,8 @@ class APNs(object):
                 return self.kFailure
 
         except ssl.SSLError:
+            if trace:
+                trace.stamp('confirmed')
 
             # Timeout error - no news is good news
             #
@@ -237,12 +374,52 @@ class APNs(object):
 
         return self.kOK
 
+    # Size of the history deque's pointer to each entry
+    #
+    kHistorySlotSize = struct.calcsize('P')
+
+    @staticmethod
+    def requestSize(request):
+        '''Approximate number of bytes held by a request in the history. getsizeof on a __slots__ object does not
+        count the objects its slots refer to, so add the frame, timestamp and identifier. Small attempt counts
+        are shared ints and not counted.
+        '''
+        return (sys.getsizeof(request) + sys.getsizeof(request.msg) + sys.getsizeof(request.when) +
+                sys.getsizeof(request.identifier) + APNs.kHistorySlotSize)
+
+    def clearHistory(self):
+        self.__history = collections.deque()
+        self.__historyBytes = 0
+
+    def historyUsage(self):
+        '''Return the number of requests held in the history and their approximate size in bytes.
+        '''
+
+        # Deliberately not taking the lock: post() holds it while waiting on APNs. Each value is a single
+        # atomic read, so the worst case is counts that are one request apart.
+        #
+        return {'count': len(self.__history),
+                'bytes': self.__historyBytes,
+                'limit': config.historyMemoryLimit,
+                'evicted': self.__historyEvictions}
+
     def pruneHistory(self):
 
-        # Find the first entry that is not stale and make that the first entry in the history
+        # Drop entries from the front of the history while they are stale or the history is over its
+        # memory budget.
         #
         now = time.time()
-        for index, request in enumerate(self.__history):
+        history = self.__history
+        evicted = 0
+        while len(history) > 0 and (now - history[0].when >= config.historyAgeLimit or
+                                    self.__historyBytes > config.historyMemoryLimit):
+            request = history.popleft()
+            self.__historyBytes -= self.requestSize(request)
             if now - request.when < config.historyAgeLimit:
-                self.__history = self.__history[index:]
-                break
+                evicted += 1
+
+        # Entries dropped for memory while still inside the age window can no longer be replayed.
+        #
+        if evicted > 0:
+            self.__historyEvictions += evicted
+            gLog.warning('history over memory limit - dropped', evicted, 'replayable requests')
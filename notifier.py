@@ -2,48 +2,123 @@ import config
 import Logger
 import emitter
 import json
+import signal
+import tracer
 
 from flask import (Flask, abort, jsonify, request)
 
 apns = emitter.APNs()
+traces = tracer.Tracer()
 
 app = Flask(__name__)
 
 OK = ('', 200, {})
 BAD = ('', 400, {})
+ACCEPTED = ('', 202, {})
+FAILED = ('', 500, {})
 
 @app.route('/api/v1/send_push', methods = ['POST'])
 def notify():
     ''' Accepts JSON payloads describing a notification to send.
     '''
-    data = json.loads(request.data)
-    gLog.info(data)
-    type = data.get('type')
-    if type != 'message':
-        gLog.error('invalid message type:', type)
-        return BAD
+    trace = traces.start()
+    outcome = 'error'
+    try:
+        data = json.loads(request.data)
+        if trace:
+            trace.stamp('parsed')
+        gLog.info(data)
+        type = data.get('type')
+        if type != 'message':
+            gLog.error('invalid message type:', type)
+            outcome = 'bad'
+            return BAD
 
-    platform = data.get('platform')
-    if platform != 'apple':
-        gLog.error('invalid platform:', platform)
-        return BAD
+        platform = data.get('platform')
+        if platform != 'apple':
+            gLog.error('invalid platform:', platform)
+            outcome = 'bad'
+            return BAD
 
-    deviceToken = data.get('device_id', '')
-    if len(deviceToken) != 64:
-        gLog.error('invalid device token:', deviceToken)
-        return BAD
+        deviceToken = data.get('device_id', '')
+        if len(deviceToken) != 64:
+            gLog.error('invalid device token:', deviceToken)
+            outcome = 'bad'
+            return BAD
+
+        channelName = data.get('channel_name', '')
+        if not channelName.startswith('taskme'):
+            gLog.info('skipping channel', channelName)
+            outcome = 'skipped'
+            return OK
+
+        badge = data.get('badge', 1)
+        gLog.debug('badge:', badge)
 
-    channelName = data.get('channel_name', '')
-    if not channelName.startswith('taskme'):
-        gLog.info('skipping channel', channelName)
+        if apns.post(deviceToken, "You have a new message", badge, trace = trace) is False:
+            outcome = 'bad'
+        else:
+            outcome = 'ok'
         return OK
 
-    badge = data.get('badge', 1)
-    gLog.debug('badge:', badge)
+    finally:
+        if trace:
+            traces.finish(trace, outcome)
+
+@app.route('/api/v1/admin/reload_config', methods = ['POST'])
+def reloadConfig():
+    ''' Reloads config.py and applies it to the live APNs connection. Returns 202 if the new values are live
+    but the APNs connection could not be rotated yet, and 500 if config.py could not be loaded.
+    '''
+    rc = apns.reloadConfig()
+    if rc == apns.kReloaded:
+        return OK
+    if rc == apns.kRotationDeferred:
+        return ACCEPTED
+    return FAILED
+
+@app.route('/api/v1/admin/history', methods = ['GET'])
+def getHistory():
+    ''' Returns the number of notifications held for replay and their approximate memory use.
+    '''
+    return jsonify(apns.historyUsage())
+
+@app.route('/api/v1/admin/traces', methods = ['GET'])
+def getTraces():
+    ''' Returns the per-stage timing breakdown of traced requests and the most recent slow traces.
+    '''
+    return jsonify(traces.summary())
+
+@app.route('/api/v1/admin/traces', methods = ['DELETE'])
+def resetTraces():
+    ''' Clears the collected trace aggregates and slow traces.
+    '''
+    traces.reset()
+    return OK
 
-    apns.post(deviceToken, "You have a new message", badge)
+@app.route('/api/v1/admin/profile', methods = ['POST'])
+def startProfile():
+    ''' Runs cProfile on the next `count' notification requests (default 10).
+    '''
+    data = json.loads(request.data or '{}')
+    count = data.get('count', 10)
+    if not isinstance(count, int) or count < 1:
+        gLog.error('invalid profile count:', count)
+        return BAD
+    traces.profileNext(count)
     return OK
 
+@app.route('/api/v1/admin/profile', methods = ['GET'])
+def getProfile():
+    ''' Returns the cProfile report accumulated over the profiled requests.
+    '''
+    return (traces.profileReport(), 200, {'Content-Type': 'text/plain'})
+
+def onSIGHUP(signum, frame):
+    gLog.info('SIGHUP - config reload requested')
+    apns.requestReload()
+
 if __name__ == '__main__':
     gLog.setLevel(gLog.kDebug)
+    signal.signal(signal.SIGHUP, onSIGHUP)
     app.run(port = config.servicePort, debug = config.enableDebugMode)
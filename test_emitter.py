@@ -0,0 +1,281 @@
+import config
+import emitter
+import os
+import shutil
+import ssl
+import struct
+import sys
+import tempfile
+import tracer
+import unittest
+
+try:
+    from importlib import reload
+except ImportError:
+    pass                        # Python 2 - use builtin reload
+
+# post() builds frames by joining str and struct.pack output, which only works on Python 2.
+#
+sendPathOnly = unittest.skipIf(sys.version_info[0] > 2, 'send path runs on Python 2')
+
+kDeviceToken = 'ab' * 32
+
+def errorFrame(status, identifier):
+    return struct.pack('!BBI', 8, status, identifier)
+
+class FakeService(object):
+    '''Stands in for the APNs TLS socket. Each recv returns the next scripted response, or times out.
+    '''
+    def __init__(self, responses = ()):
+        self.responses = list(responses)
+        self.written = []
+        self.closed = False
+        self.timeout = None
+
+    def write(self, msg):
+        self.written.append(msg)
+        return len(msg)
+
+    def recv(self, size):
+        if self.responses:
+            return self.responses.pop(0)
+        raise ssl.SSLError('The read operation timed out')
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def close(self):
+        self.closed = True
+
+class ReloadConfigTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.dontWriteBytecode = sys.dont_write_bytecode
+        sys.dont_write_bytecode = True
+
+    def tearDown(self):
+        if self.dir in sys.path:
+            sys.path.remove(self.dir)
+        reload(config)
+        sys.dont_write_bytecode = self.dontWriteBytecode
+        shutil.rmtree(self.dir)
+
+    def writeConfig(self, **changes):
+        '''Write a copy of config.py with the given values appended, and make it the one that reload finds.
+        '''
+        with open(config.__file__.replace('.pyc', '.py')) as fd:
+            source = fd.read()
+        for name, value in changes.items():
+            source += '\n{} = {!r}\n'.format(name, value)
+        with open(os.path.join(self.dir, 'config.py'), 'w') as fd:
+            fd.write(source)
+        sys.path.insert(0, self.dir)
+
+    def testReloadAppliesChangedValues(self):
+        apns = emitter.APNs()
+        self.writeConfig(socketAgeLimit = 7, useSandbox = False)
+        self.assertEqual(apns.reloadConfig(), apns.kReloaded)
+        self.assertEqual(config.socketAgeLimit, 7)
+        self.assertEqual(apns.host, 'gateway.push.apple.com')
+
+    def connected(self):
+        '''Return an APNs connected to a FakeService, with one request in its history.
+        '''
+        apns = emitter.APNs()
+        service = FakeService()
+        apns.openConnection = lambda: service
+        apns.connect()
+        apns.processOne(emitter.PushRequest(1, b'x' * 100))
+        return apns, service
+
+    def testTunablesAppliedToLiveConnection(self):
+        apns, old = self.connected()
+        self.writeConfig(socketReadTimeout = 5.0)
+        self.assertEqual(apns.reloadConfig(), apns.kReloaded)
+        self.assertEqual(old.timeout, 5.0)
+        self.assertFalse(old.closed)
+        self.assertEqual(apns.historyUsage()['count'], 1)
+
+    def testRotationOpensNewConnectionBeforeClosingOld(self):
+        apns, old = self.connected()
+        new = FakeService()
+        oldClosedAtOpen = []
+
+        def openConnection():
+            oldClosedAtOpen.append(old.closed)
+            return new
+
+        apns.openConnection = openConnection
+        pending = emitter.PushRequest(2, b'y' * 100)
+        apns._APNs__pending.append(pending)
+        whenLastPost = apns._APNs__whenLastPost
+
+        self.writeConfig(useSandbox = False)
+        self.assertEqual(apns.reloadConfig(), apns.kReloaded)
+        self.assertEqual(oldClosedAtOpen, [False])
+        self.assertTrue(old.closed)
+        self.assertEqual(apns.host, 'gateway.push.apple.com')
+        self.assertEqual(apns._APNs__pending, [pending])
+        self.assertEqual(apns.historyUsage()['count'], 0)
+        self.assertEqual(apns.historyUsage()['bytes'], 0)
+        self.assertGreaterEqual(apns._APNs__whenLastPost, whenLastPost)
+
+        apns.processOne(emitter.PushRequest(3, b'z' * 100))
+        self.assertEqual(len(new.written), 1)
+        self.assertEqual(len(old.written), 1)
+
+    def testRotationDeferredKeepsOldConnection(self):
+        apns, old = self.connected()
+        apns.openConnection = lambda: None
+        self.writeConfig(useSandbox = False, socketAgeLimit = 7)
+        self.assertEqual(apns.reloadConfig(), apns.kRotationDeferred)
+        self.assertEqual(config.socketAgeLimit, 7)
+        self.assertFalse(old.closed)
+        self.assertEqual(apns.host, 'gateway.sandbox.push.apple.com')
+        self.assertEqual(apns.historyUsage()['count'], 1)
+
+        apns.processOne(emitter.PushRequest(2, b'y' * 100))
+        self.assertEqual(len(old.written), 2)
+
+    def testFailedReloadKeepsValues(self):
+        apns, old = self.connected()
+        with open(os.path.join(self.dir, 'config.py'), 'w') as fd:
+            fd.write('socketAgeLimit = \n')
+        sys.path.insert(0, self.dir)
+        self.assertEqual(apns.reloadConfig(), apns.kReloadFailed)
+        self.assertEqual(config.socketAgeLimit, 2 * 60)
+
+    @sendPathOnly
+    def testRequestedReloadAppliedOnNextPost(self):
+        apns, service = self.connected()
+        self.writeConfig(socketAgeLimit = 7)
+        apns.requestReload()
+        self.assertEqual(config.socketAgeLimit, 2 * 60)
+        apns.post(kDeviceToken, 'hello', 1)
+        self.assertEqual(config.socketAgeLimit, 7)
+        self.assertEqual(len(service.written), 2)
+
+class HistoryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.memoryLimit = config.historyMemoryLimit
+        self.ageLimit = config.historyAgeLimit
+
+    def tearDown(self):
+        config.historyMemoryLimit = self.memoryLimit
+        config.historyAgeLimit = self.ageLimit
+
+    def fillHistory(self, apns, count):
+        for identifier in range(count):
+            request = emitter.PushRequest(identifier, b'x' * 100)
+            apns._APNs__history.append(request)
+            apns._APNs__historyBytes += apns.requestSize(request)
+
+    def testMemoryBudgetEvictsOldestAndCounts(self):
+        apns = emitter.APNs()
+        self.fillHistory(apns, 50)
+        size = apns.requestSize(emitter.PushRequest(0, b'x' * 100))
+        config.historyMemoryLimit = 4 * size
+        apns.pruneHistory()
+        usage = apns.historyUsage()
+        self.assertEqual(usage['count'], 4)
+        self.assertEqual(usage['bytes'], 4 * size)
+        self.assertEqual(usage['evicted'], 46)
+
+    def testRequestSizeCountsSlotValues(self):
+        request = emitter.PushRequest(123456, b'x' * 150)
+        shallow = sys.getsizeof(request) + sys.getsizeof(request.msg)
+        self.assertGreater(emitter.APNs.requestSize(request),
+                           shallow + sys.getsizeof(request.when) + sys.getsizeof(request.identifier))
+
+    def testAgeLimitEvictionIsNotCounted(self):
+        apns = emitter.APNs()
+        self.fillHistory(apns, 10)
+        config.historyAgeLimit = -1
+        apns.pruneHistory()
+        usage = apns.historyUsage()
+        self.assertEqual(usage['count'], 0)
+        self.assertEqual(usage['bytes'], 0)
+        self.assertEqual(usage['evicted'], 0)
+
+class ReplayTest(unittest.TestCase):
+
+    def connected(self, responses = ()):
+        apns = emitter.APNs()
+        service = FakeService(responses)
+        apns.openConnection = lambda: service
+        apns.connect()
+        return apns, service
+
+    def testErrorReplaysLaterRequests(self):
+        apns, service = self.connected()
+        requests = [emitter.PushRequest(identifier, b'x' * 100) for identifier in range(1, 5)]
+        for request in requests[:3]:
+            self.assertEqual(apns.processOne(request), apns.kOK)
+
+        usage = apns.historyUsage()
+        self.assertEqual(usage['count'], 3)
+        self.assertEqual(usage['bytes'], 3 * apns.requestSize(requests[0]))
+
+        # APNs rejects request 2, so 3 and 4 were dropped and must be resent.
+        #
+        service.responses.append(errorFrame(8, 2))
+        self.assertEqual(apns.processOne(requests[3]), apns.kFailure)
+        self.assertTrue(service.closed)
+        self.assertEqual(apns._APNs__pending, requests[2:])
+        self.assertEqual([request.attempts for request in requests], [1, 1, 0, 0])
+        usage = apns.historyUsage()
+        self.assertEqual(usage['count'], 0)
+        self.assertEqual(usage['bytes'], 0)
+
+    def testErrorForLastRequestReplaysNothing(self):
+        apns, service = self.connected([None, errorFrame(8, 2)])
+        first = emitter.PushRequest(1, b'x' * 100)
+        second = emitter.PushRequest(2, b'x' * 100)
+        self.assertEqual(apns.processOne(first), apns.kOK)
+        self.assertEqual(apns.processOne(second), apns.kFailure)
+        self.assertEqual(apns._APNs__pending, [])
+        self.assertEqual(apns.historyUsage()['count'], 2)
+
+    def testWriteFailureRequeues(self):
+        apns, service = self.connected()
+        service.write = lambda msg: 0
+        request = emitter.PushRequest(1, b'x' * 100)
+        self.assertEqual(apns.processOne(request), apns.kRetry)
+        self.assertEqual(apns._APNs__pending, [request])
+        self.assertEqual(request.attempts, 1)
+        self.assertEqual(apns.historyUsage()['bytes'], 0)
+
+    @sendPathOnly
+    def testShutdownResendsWithoutDuplicates(self):
+        apns, service = self.connected()
+        apns.post(kDeviceToken, 'first', 1)
+        service.responses.append(errorFrame(10, 1))
+        apns.post(kDeviceToken, 'second', 1)
+        self.assertEqual(service.written[1:], [service.written[1]] * 2)
+        self.assertEqual(apns._APNs__pending, [])
+
+class TraceTest(unittest.TestCase):
+
+    @sendPathOnly
+    def testReplayDoesNotStampFinishedTrace(self):
+        apns = emitter.APNs()
+        service = FakeService()
+        apns.openConnection = lambda: service
+        trace = tracer.Trace()
+        apns.post(kDeviceToken, 'first', 1, trace = trace)
+        stamps = [stage for stage, when in trace.stamps]
+        self.assertEqual(stamps, ['accept', 'payload', 'framed', 'enqueue', 'write', 'written', 'confirmed'])
+
+        # APNs shuts down the connection after the second post, so both requests are replayed.
+        #
+        first = service.written[0]
+        service.responses.append(errorFrame(10, 0))
+        apns.post(kDeviceToken, 'second', 1)
+        second = service.written[1]
+        self.assertEqual(service.written, [first, second, first, second])
+        self.assertEqual([stage for stage, when in trace.stamps], stamps)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+import config
+import tracer
+import unittest
+
+class TracerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sampleRate = config.traceSampleRate
+        self.slowThreshold = config.traceSlowThreshold
+
+    def tearDown(self):
+        config.traceSampleRate = self.sampleRate
+        config.traceSlowThreshold = self.slowThreshold
+
+    def testNotSampled(self):
+        config.traceSampleRate = 0.0
+        self.assertEqual(tracer.Tracer().start(), None)
+
+    def testStageBreakdown(self):
+        config.traceSampleRate = 1.0
+        config.traceSlowThreshold = 0.0
+        traces = tracer.Tracer()
+        trace = traces.start()
+        trace.stamp('parsed')
+        traces.finish(trace)
+        summary = traces.summary()
+        self.assertEqual(summary['count'], 1)
+        self.assertEqual(list(summary['stages'].keys()), ['parsed', 'done'])
+        self.assertEqual(len(summary['slow']), 1)
+
+    def testRetriedStagesAreNumbered(self):
+        trace = tracer.Trace()
+        trace.stamp('write')
+        trace.stamp('write')
+        self.assertEqual([stage for stage, when in trace.stamps], ['accept', 'write', 'write#2'])
+
+    def testRejectedRequestsDoNotSkewStages(self):
+        config.traceSampleRate = 1.0
+        config.traceSlowThreshold = 0.0
+        traces = tracer.Tracer()
+        trace = traces.start()
+        trace.stamp('parsed')
+        traces.finish(trace, 'bad')
+        summary = traces.summary()
+        self.assertEqual(summary['count'], 1)
+        self.assertEqual(summary['outcomes'], {'bad': 1})
+        self.assertEqual(len(summary['stages']), 0)
+        self.assertEqual(len(summary['slow']), 0)
+
+    def testProfileReport(self):
+        config.traceSampleRate = 0.0
+        traces = tracer.Tracer()
+        traces.profileNext(1)
+        trace = traces.start()
+        self.assertNotEqual(trace, None)
+        traces.finish(trace)
+        self.assertEqual(traces.start(), None)
+        self.assertIn('function calls', traces.profileReport())
+
+if __name__ == '__main__':
+    unittest.main()
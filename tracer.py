@@ -0,0 +1,149 @@
+import config
+import collections
+import cProfile
+import pstats
+import random
+import threading
+import time
+import Logger
+
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from io import StringIO     # Python 3
+
+# Python 2 has no monotonic clock in the standard library
+#
+monotonic = getattr(time, 'monotonic', time.time)
+
+class Trace(object):
+    '''Monotonic timestamps for each processing stage of one notification request.
+    '''
+    def __init__(self, profile = None):
+        self.stamps = []
+        self.profile = profile
+        self.outcome = None
+        self.repeats = {}
+        self.stamp('accept')
+
+    def stamp(self, stage):
+        '''Record the time a stage was reached. Repeated stages (retried writes) are recorded as `stage#2', `stage#3'
+        and so on, so that they do not get averaged in with the first attempt.
+        '''
+        repeats = self.repeats.get(stage, 0) + 1
+        self.repeats[stage] = repeats
+        if repeats > 1:
+            stage = '{}#{}'.format(stage, repeats)
+        self.stamps.append((stage, monotonic()))
+
+    def total(self):
+        return self.stamps[-1][1] - self.stamps[0][1]
+
+    def breakdown(self):
+        '''Return list of (stage, seconds since previous stage) pairs.
+        '''
+        return [(stage, when - self.stamps[index][1])
+                for index, (stage, when) in enumerate(self.stamps[1:])]
+
+    def asDict(self):
+        return {'total': self.total(), 'outcome': self.outcome, 'stages': self.breakdown()}
+
+class Tracer(object):
+    '''Samples notification requests for tracing and optional cProfile runs, and keeps per-stage aggregates.
+    '''
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__profileRemaining = 0
+        self.__profileStats = None
+        self.reset()
+
+    def reset(self):
+        with self.__lock:
+            self.__count = 0
+            self.__outcomes = {}
+            self.__stages = collections.OrderedDict()
+            self.__slow = collections.deque(maxlen = config.traceSlowKeep)
+
+    def start(self):
+        '''Return a new Trace if this request is sampled, otherwise None.
+        '''
+        profile = None
+        with self.__lock:
+            if self.__profileRemaining > 0:
+                self.__profileRemaining -= 1
+                profile = cProfile.Profile()
+            elif config.traceSampleRate <= 0 or random.random() >= config.traceSampleRate:
+                return None
+
+        trace = Trace(profile)
+        if profile:
+            profile.enable()
+        return trace
+
+    def finish(self, trace, outcome = 'ok'):
+        '''Complete a trace. Every started trace must be finished, whatever the outcome of the request, so that
+        profiling stops. Only traces with an `ok' outcome contribute to the stage aggregates and slow traces.
+        '''
+        trace.stamp('done')
+        trace.outcome = outcome
+        if trace.profile:
+            trace.profile.disable()
+
+        total = trace.total()
+        slow = outcome == 'ok' and total >= config.traceSlowThreshold
+        with self.__lock:
+            self.__count += 1
+            self.__outcomes[outcome] = self.__outcomes.get(outcome, 0) + 1
+            if outcome == 'ok':
+                for stage, elapsed in trace.breakdown():
+                    stats = self.__stages.get(stage)
+                    if stats is None:
+                        stats = self.__stages[stage] = {'count': 0, 'total': 0.0, 'max': 0.0}
+                    stats['count'] += 1
+                    stats['total'] += elapsed
+                    stats['max'] = max(stats['max'], elapsed)
+
+            if slow:
+                if self.__slow.maxlen != config.traceSlowKeep:
+                    self.__slow = collections.deque(self.__slow, maxlen = config.traceSlowKeep)
+                self.__slow.append(trace)
+
+            if trace.profile:
+                if self.__profileStats is None:
+                    self.__profileStats = pstats.Stats(trace.profile)
+                else:
+                    self.__profileStats.add(trace.profile)
+                trace.profile = None
+
+        if slow:
+            gLog.warning('slow request:', total, trace.breakdown())
+
+    def summary(self):
+        '''Return the per-stage aggregate breakdown and the kept slow traces.
+        '''
+        with self.__lock:
+            stages = collections.OrderedDict()
+            for stage, stats in self.__stages.items():
+                stages[stage] = {'count': stats['count'],
+                                 'mean': stats['total'] / stats['count'],
+                                 'max': stats['max']}
+            return {'count': self.__count,
+                    'outcomes': dict(self.__outcomes),
+                    'stages': stages,
+                    'slow': [trace.asDict() for trace in self.__slow]}
+
+    def profileNext(self, count):
+        '''Run cProfile on the next `count' requests, discarding any previously collected profile data.
+        '''
+        with self.__lock:
+            self.__profileRemaining = count
+            self.__profileStats = None
+
+    def profileReport(self, sortKey = 'cumulative', limit = 40):
+        with self.__lock:
+            if self.__profileStats is None:
+                return ''
+            out = StringIO()
+            self.__profileStats.stream = out
+            self.__profileStats.sort_stats(sortKey).print_stats(limit)
+            return out.getvalue()